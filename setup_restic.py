@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
+import concurrent.futures
+import functools
 import json
+import mmap
 import os
 import subprocess
 import sys
 import shutil
+import threading
 import urllib.request
 import bz2
 from pathlib import Path
@@ -13,50 +17,102 @@ CONFIG_FILE = "config.json"
 EXAMPLE_CONFIG = "config.json.example"
 HOME = Path.home()
 
+# Per-service blocks of the generated backup script
+_BACKUP_TMPL = '''
+
+echo "Backing up {service}: {path}"
+/usr/local/bin/restic -p "$RESTIC_PASSWD" -r "$BACKUP_REPO" \
+    --host "$HOST_TAG" \
+    --tag "{service}" \
+    --exclude-caches \
+    --exclude-file="$RESTIC_EXCLUDE_FILE" \
+    backup "{path}"
+
+echo "{service} backup complete: $(/usr/local/bin/restic -p "$RESTIC_PASSWD" -r "$BACKUP_REPO" stats --host "$HOST_TAG" --tag "{service}")"
+'''
+
+_FORGET_TMPL = '''
+
+/usr/local/bin/restic -p "$RESTIC_PASSWD" -r "$BACKUP_REPO" \
+    forget \
+    --host "$HOST_TAG" \
+    --tag "{service}" \
+    --group-by host,tags \
+    $KEEP_OPTIONS \
+    --cleanup-cache || true
+'''
+
+@functools.lru_cache(maxsize=1)
 def load_config():
-    if not os.path.exists(CONFIG_FILE):
+    try:
+        return json.loads(Path(CONFIG_FILE).read_bytes())
+    except FileNotFoundError:
         print(f"[ERROR] {CONFIG_FILE} not found. Please copy {EXAMPLE_CONFIG} to {CONFIG_FILE} and edit it.")
         sys.exit(1)
-    
-    with open(CONFIG_FILE, 'r') as f:
-        return json.load(f)
 
 def check_command(command):
     return shutil.which(command) is not None
 
+def _write_secure(path, data, mode):
+    # Create the file with its final mode so secrets are never exposed at the umask
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        # Files left by earlier runs keep their old mode, and umask masks new ones
+        os.fchmod(fd, mode)
+    except OSError:
+        os.close(fd)
+        raise
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data if isinstance(data, bytes) else data.encode())
+
 # --- Tasks ---
 
-def task_install(config):
+def task_download(config, cancel):
     version = config.get('restic_version', '0.18.1')
     print(f"[INFO] Checking for restic...")
     if check_command("restic"):
         print("[INFO] restic is already installed.")
-        return
+        return False
 
     print(f"[INFO] Installing restic version {version}...")
     url = f"https://github.com/restic/restic/releases/download/v{version}/restic_{version}_linux_amd64.bz2"
-    temp_bz2 = "/tmp/restic.bz2"
-    restic_bin = Path("/usr/local/bin/restic")
     
     try:
-        print(f"[INFO] Downloading {url}...")
-        urllib.request.urlretrieve(url, temp_bz2)
+        print(f"[INFO] Downloading and extracting {url}...")
+        decompressor = bz2.BZ2Decompressor()
+        fd = os.open('/tmp/restic', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+        request = urllib.request.Request(url, headers={'Accept-Encoding': 'identity'})
+        received = 0
+        with os.fdopen(fd, 'wb') as dest, urllib.request.urlopen(request, timeout=30) as response:
+            # The os.open mode is masked by umask and ignored for a leftover /tmp/restic
+            os.fchmod(dest.fileno(), 0o755)
+            expected = response.headers.get('Content-Length')
+            while chunk := response.read(1 << 20):
+                if cancel.is_set():
+                    return False
+                received += len(chunk)
+                dest.write(decompressor.decompress(chunk))
+        if expected is not None and received != int(expected):
+            raise EOFError(f"downloaded {received} of {expected} bytes")
+        if not decompressor.eof:
+            raise EOFError("compressed stream ended before the end-of-stream marker")
         
-        print("[INFO] Extracting...")
-        with open(temp_bz2, 'rb') as source, open('/tmp/restic', 'wb') as dest:
-            dest.write(bz2.decompress(source.read()))
-            
+    except Exception as e:
+        print(f"[ERROR] Failed to download restic: {e}")
+        sys.exit(1)
+    return True
+
+def task_install(config):
+    restic_bin = Path("/usr/local/bin/restic")
+    
+    try:
         print("[INFO] Installing to /usr/local/bin/restic (requires sudo)...")
-        os.chmod('/tmp/restic', 0o755)
         subprocess.check_call(['sudo', 'mv', '/tmp/restic', str(restic_bin)])
         subprocess.check_call(['sudo', 'chown', 'root:root', str(restic_bin)])
         
     except Exception as e:
         print(f"[ERROR] Failed to install restic: {e}")
         sys.exit(1)
-    finally:
-        if os.path.exists(temp_bz2):
-            os.remove(temp_bz2)
 
 def task_setup(config):
     print("[INFO] Setting up directories and configuration files...")
@@ -69,23 +125,25 @@ def task_setup(config):
     
     # Write password file
     passwd_file = restic_dir / ".restic_passwd"
-    with open(passwd_file, 'w') as f:
-        f.write(config['backup_password'])
-    passwd_file.chmod(0o600)
+    _write_secure(passwd_file, config['backup_password'], 0o600)
     
     # Write exclude file
     exclude_file = restic_dir / ".restic_exclude"
-    with open(exclude_file, 'w') as f:
-        f.write("\n".join(config['exclude_paths']))
+    _write_secure(exclude_file, b"\n".join(p.encode() for p in config['exclude_paths']), 0o644)
     
     # Add bin to PATH in .bashrc if not present
     bashrc = HOME / ".bashrc"
     if bashrc.exists():
-        with open(bashrc, 'r') as f:
-            content = f.read()
-        
         export_line = 'export PATH=$PATH:$HOME/bin'
-        if export_line not in content and f'$HOME/bin' not in content:
+        with open(bashrc, 'rb') as f:
+            # mmap cannot map an empty file
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    found = mm.find(b'$HOME/bin') >= 0
+            else:
+                found = False
+        
+        if not found:
             print("[INFO] Adding ~/bin to PATH in .bashrc")
             with open(bashrc, 'a') as f:
                 f.write(f"\n{export_line}\n")
@@ -96,33 +154,19 @@ def task_backup_script(config):
     bin_dir = HOME / "bin"
     restic_dir = HOME / ".restic"
     script_path = bin_dir / "restic-custom-backup"
+    host = os.uname().nodename
+    repository = config['repository']
+    healthcheck_url = config.get('healthcheck_url', '')
     
-    sources_block = ""
-    forget_block = ""
+    sources_parts = []
+    forget_parts = []
     
     for service, path in config['source_paths'].items():
-        sources_block += f'''
+        sources_parts.append(_BACKUP_TMPL.format(service=service, path=path))
+        forget_parts.append(_FORGET_TMPL.format(service=service))
 
-echo "Backing up {service}: {path}"
-/usr/local/bin/restic -p "$RESTIC_PASSWD" -r "$BACKUP_REPO" \
-    --host "$HOST_TAG" \
-    --tag "{service}" \
-    --exclude-caches \
-    --exclude-file="$RESTIC_EXCLUDE_FILE" \
-    backup "{path}"
-
-echo "{service} backup complete: $(/usr/local/bin/restic -p "$RESTIC_PASSWD" -r "$BACKUP_REPO" stats --host "$HOST_TAG" --tag "{service}")"
-'''
-        forget_block += f'''
-
-/usr/local/bin/restic -p "$RESTIC_PASSWD" -r "$BACKUP_REPO" \
-    forget \
-    --host "$HOST_TAG" \
-    --tag "{service}" \
-    --group-by host,tags \
-    $KEEP_OPTIONS \
-    --cleanup-cache || true
-'''
+    sources_block = "".join(sources_parts)
+    forget_block = "".join(forget_parts)
 
     script_content = f'''#!/bin/bash
 set -euo pipefail
@@ -130,10 +174,10 @@ set -euo pipefail
 # Configuration
 RESTIC_PASSWD="{restic_dir}/.restic_passwd"
 RESTIC_EXCLUDE_FILE="{restic_dir}/.restic_exclude"
-BACKUP_REPO="{config['repository']}"
+BACKUP_REPO="{repository}"
 KEEP_OPTIONS="--keep-hourly 2 --keep-daily 6 --keep-weekly 3 --keep-monthly 1"
-HOST_TAG="{os.uname().nodename}"
-HEALTHCHECK_URL="{config.get('healthcheck_url', '')}"
+HOST_TAG="{host}"
+HEALTHCHECK_URL="{healthcheck_url}"
 
 FAILURE=0
 LOGFILE="/tmp/restic-backup.log"
@@ -173,9 +217,7 @@ echo "=== Backup finished: $(date) ==="
 exit $FAILURE
 '''
     
-    with open(script_path, 'w') as f:
-        f.write(script_content)
-    script_path.chmod(0o755)
+    _write_secure(script_path, script_content, 0o755)
     print(f"[INFO] Backup script written to {script_path}")
 
 def task_cron(config):
@@ -199,15 +241,31 @@ def task_cron(config):
     
     process = subprocess.Popen(['crontab', '-'], stdin=subprocess.PIPE)
     process.communicate(input=new_cron.encode('utf-8'))
+    if process.returncode != 0:
+        print("[ERROR] Failed to install cron job.")
+        return
     print("[INFO] Cron job added.")
 
 # --- Main ---
 
 def main():
     config = load_config()
-    task_install(config)
-    task_setup(config)
-    task_backup_script(config)
+    # The download is network-bound and independent of the local setup steps
+    cancel = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        download = executor.submit(task_download, config, cancel)
+        try:
+            task_setup(config)
+            task_backup_script(config)
+            # Re-raises the download failure so no cron job points at a missing binary
+            downloaded = download.result()
+        except BaseException:
+            # Stop the download on Ctrl-C or a failed step instead of waiting it out
+            cancel.set()
+            raise
+    # sudo may prompt, so install from the main thread once the download is done
+    if downloaded:
+        task_install(config)
     task_cron(config)
     print("[INFO] Setup complete!")
 